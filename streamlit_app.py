@@ -1,118 +1,237 @@
+import gc
+import gzip
+import hashlib
 import os
-import time
+import shutil
 import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 import streamlit as st
 from dotenv import load_dotenv
 
 BASE_URL = "https://llmwhisperer-api.us-central.unstract.com/api/v2"
 
-def whisper_start(file_path, api_key, mode="high_quality", pages="", vert=False, horiz=False, output_mode="layout_preserving"):
-    # params go in the query string per docs
+# uploads below this size are sent straight from memory; larger ones are
+# streamed through a temp file to keep RSS bounded
+_INMEMORY_LIMIT = 64 * 1024 * 1024
+
+# opt-in: gzip the upload body to roughly halve bytes on a slow upstream.
+# Leave off until the target deployment is confirmed to honor
+# Content-Encoding on the raw /whisper body.
+_GZIP_UPLOADS = os.getenv("LLMWHISPERER_GZIP_UPLOADS", "").lower() in ("1", "true", "yes")
+# already-compressed formats (images etc.) gain nothing from another pass
+_COMPRESSIBLE_EXTS = {".pdf", ".docx", ".txt"}
+
+st.set_page_config(page_title="LLMWhisperer Extractor", page_icon="🗂️", layout="centered")
+
+@st.cache_resource(show_spinner=False)
+def _api_key():
+    # Streamlit re-executes the whole script on every rerun, so module scope
+    # alone does not help; cache_resource makes the .env read+parse and the
+    # secrets lookup happen once per worker process.
+    load_dotenv(override=False)
+    return st.secrets.get("LLMWHISPERER_API_KEY", os.getenv("LLMWHISPERER_API_KEY"))
+
+@st.cache_resource(show_spinner=False)
+def _get_session(api_key):
+    # One session per worker (and per key, so credential swaps still work):
+    # cache_resource keeps the connection pool and TLS state alive across
+    # Streamlit reruns instead of re-handshaking on every widget interaction.
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    session.headers["unstract-key"] = api_key
+    # advertise compression so a multi-MB result_text ships gzipped (requests
+    # decompresses transparently), and make keep-alive explicit
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+def _gzip_stream(f):
+    # yield gzip-compressed chunks of an open file; requests sends the
+    # generator with chunked encoding, so the compressed body never fully
+    # materializes in memory
+    comp = zlib.compressobj(1, zlib.DEFLATED, 31)  # wbits=31 -> gzip framing
+    while chunk := f.read(1024 * 1024):
+        out = comp.compress(chunk)
+        if out:
+            yield out
+    yield comp.flush()
+
+def whisper_extract(payload, api_key, mode="high_quality", pages="", vert=False, horiz=False, output_mode="layout_preserving", compress=False):
+    # params go in the query string per docs; the flags are lowercase strings
+    # because the server rejects requests-style "True"/"False" serialization
     params = {
         "mode": mode,
         "output_mode": output_mode,
+        "mark_vertical_lines": "true" if vert else "false",
+        "mark_horizontal_lines": "true" if horiz else "false",
+        # server-side long poll: the request blocks until the job is done
+        # (or wait_timeout elapses), so no client-side status loop is needed
+        "wait_for_completion": "true",
+        "wait_timeout": 200,
     }
     if pages:
         params["pages_to_extract"] = pages
-    if vert:
-        params["mark_vertical_lines"] = "true"
-    if horiz:
-        params["mark_horizontal_lines"] = "true"
-
-    headers = {"unstract-key": api_key}
-    with open(file_path, "rb") as f:
-        # API expects raw body; multipart generally works, but send raw bytes to match docs
-        resp = requests.post(f"{BASE_URL}/whisper", headers=headers, params=params, data=f)
+
+    headers = {"Content-Encoding": "gzip"} if compress else {}
+    # API expects raw body; payload is either the file bytes (small uploads,
+    # no temp-file round-trip) or a temp-file path whose open file object
+    # requests streams from disk in chunks.
+    if isinstance(payload, bytes):
+        body = gzip.compress(payload, compresslevel=1) if compress else payload
+        resp = _get_session(api_key).post(f"{BASE_URL}/whisper", params=params, data=body, headers=headers)
+    else:
+        with open(payload, "rb") as f:
+            body = _gzip_stream(f) if compress else f
+            resp = _get_session(api_key).post(f"{BASE_URL}/whisper", params=params, data=body, headers=headers)
     if resp.status_code == 401:
         raise RuntimeError(f"Auth failed (401). Check key and header. Body: {resp.text}")
-    if resp.status_code not in (202, 200):
-        raise RuntimeError(f"Whisper start failed {resp.status_code}: {resp.text}")
-    return resp.json().get("whisper_hash")
-
-def whisper_status(whisper_hash, api_key):
-    headers = {"unstract-key": api_key}
-    r = requests.get(f"{BASE_URL}/whisper-status", headers=headers, params={"whisper_hash": whisper_hash})
-    r.raise_for_status()
-    return r.json()
-
-def whisper_retrieve(whisper_hash, api_key):
-    headers = {"unstract-key": api_key}
-    r = requests.get(f"{BASE_URL}/whisper-retrieve", headers=headers, params={"whisper_hash": whisper_hash})
-    r.raise_for_status()
-    return r.json()
+    if resp.status_code == 202:
+        raise RuntimeError(f"Timed out waiting for completion (200s). Try again or retrieve later: {resp.text}")
+    if resp.status_code != 200:
+        raise RuntimeError(f"Whisper failed {resp.status_code}: {resp.text}")
+    return resp.json()
+
+def _stream_upload_to_tmp(uploaded):
+    # Stream to disk in 1 MiB chunks instead of uploaded.read(), which would
+    # hold the whole file in RAM a second time.
+    uploaded.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        shutil.copyfileobj(uploaded, tmp, length=1024 * 1024)
+        return tmp.name
+
+def _fileobj_sha256(f):
+    if hasattr(hashlib, "file_digest"):
+        # 3.11+: hashes in a C loop without Python-level chunk iteration
+        return hashlib.file_digest(f, "sha256").hexdigest()
+    h = hashlib.sha256()
+    while chunk := f.read(1024 * 1024):
+        h.update(chunk)
+    return h.hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _extract_cached(file_digest, mode, pages, vert, horiz, api_key, _payload, _compress=False):
+    # keyed on the file's SHA-256 plus the extraction options, so re-clicking
+    # Extract on the same file costs zero network and zero API credits;
+    # _payload and _compress are underscore-prefixed to stay out of the cache
+    # key (transport details do not change the result).
+    return whisper_extract(_payload, api_key, mode, pages, vert, horiz, compress=_compress)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _utf8(text):
+    # the download payload is rebuilt on every rerun; cache the encode so a
+    # multi-MB result is not re-encoded on each widget interaction
+    return text.encode("utf-8")
 
 def main():
-    st.set_page_config(page_title="LLMWhisperer Extractor", page_icon="🗂️", layout="centered")
     st.title("🗂️ LLMWhisperer Extractor (REST)")
 
-    load_dotenv(override=False)
-    api_key = st.secrets.get("LLMWHISPERER_API_KEY", os.getenv("LLMWHISPERER_API_KEY"))
+    api_key = _api_key()
     if not api_key:
         st.error("❌ Missing `LLMWHISPERER_API_KEY`. Add it to .env or Streamlit Secrets.")
         st.stop()
 
-    uploaded = st.file_uploader("Choose a file", type=None)
-    mode = st.selectbox("Extraction mode", ["native_text", "low_cost", "high_quality", "form", "table"], index=2)
-    pages = st.text_input("Pages to extract (optional)", placeholder='e.g. "1-5", "7", "1-5,7,21-"')
-    vert = st.checkbox("Recreate vertical table borders (--vert)", value=False)
-    horiz = st.checkbox("Recreate horizontal table borders (--horiz)", value=False)
+    # clear_on_submit resets the uploader after Extract, so Streamlit does not
+    # keep the uploaded bytes alive in session state for the rest of the session
+    with st.form("extract", clear_on_submit=True):
+        uploads = st.file_uploader("Choose one or more files", type=None, accept_multiple_files=True, key="upload_key")
+        mode = st.selectbox("Extraction mode", ["native_text", "low_cost", "high_quality", "form", "table"], index=2)
+        pages = st.text_input("Pages to extract (optional)", placeholder='e.g. "1-5", "7", "1-5,7,21-"')
+        vert = st.checkbox("Recreate vertical table borders (--vert)", value=False)
+        horiz = st.checkbox("Recreate horizontal table borders (--horiz)", value=False)
+        submitted = st.form_submit_button("Extract")
+
     if horiz and not vert:
         st.warning("⚠️ `--horiz` requires `--vert`.")
 
-    if st.button("Extract"):
-        if not uploaded:
-            st.warning("Please upload a file.")
+    if submitted:
+        if not uploads:
+            st.warning("Please upload at least one file.")
             st.stop()
         if horiz and not vert:
             st.error("`--horiz` requires `--vert`. Please enable vertical borders.")
             st.stop()
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(uploaded.read())
-            tmp_path = tmp.name
-
-        st.info(f"Uploading **{uploaded.name}** (mode **{mode}**) ...")
-
-        try:
-            whisper_hash = whisper_start(tmp_path, api_key, mode, pages, vert, horiz)
-            if not whisper_hash:
-                st.error("No whisper_hash received; cannot continue.")
-                return
-
-            with st.spinner("Processing..."):
-                # simple poll loop (max ~200s per docs)
-                t0 = time.time()
-                while True:
-                    status = whisper_status(whisper_hash, api_key)
-                    if status.get("status") == "processed":
-                        break
-                    if status.get("status") == "failed":
-                        st.error(f"Processing failed: {status}")
-                        return
-                    if time.time() - t0 > 200:
-                        st.error("Timed out waiting for completion (200s). Try again or retrieve later.")
-                        return
-                    time.sleep(3)
-
-            data = whisper_retrieve(whisper_hash, api_key)
-            text = (data or {}).get("result_text", "") or data.get("extracted_text", "")
-            st.success("✅ Extraction complete.")
-            st.text_area("Extracted Text", text, height=350)
-            st.download_button(
-                "Download as .txt",
-                data=text.encode("utf-8"),
-                file_name=f"{os.path.splitext(uploaded.name)[0]}_extracted.txt",
-                mime="text/plain",
-            )
-
-        except Exception as e:
-            st.error(f"❌ Error: {e}")
-        finally:
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+        # digest -> tmp_path survives reruns, so re-submitting the same bytes
+        # reuses the on-disk copy instead of streaming it out again. Keyed on
+        # content, not file_id: the clear_on_submit form resets the uploader
+        # after every Extract, so a re-upload always carries a fresh file_id.
+        tmp_paths = st.session_state.setdefault("tmp_paths", {})
+
+        jobs = []
+        for index, uploaded in enumerate(uploads):
+            file_name = uploaded.name
+            file_size = uploaded.size
+            if file_size < _INMEMORY_LIMIT:
+                # typical PDFs: keep the bytes in memory and skip the
+                # temp-file write+read entirely
+                payload = uploaded.getvalue()
+                tmp_path = None
+                digest = None  # hashed from the bytes in run_job if needed
+            else:
+                uploaded.seek(0)
+                digest = _fileobj_sha256(uploaded)
+                tmp_path = tmp_paths.get(digest)
+                if tmp_path is None or not os.path.exists(tmp_path):
+                    tmp_path = _stream_upload_to_tmp(uploaded)
+                    tmp_paths[digest] = tmp_path
+                payload = tmp_path
+            uploaded.close()
+            jobs.append((index, file_name, file_size, payload, tmp_path, digest))
+        del uploads, uploaded
+        gc.collect()
+
+        # drop temp files whose content is not part of this submit, so disk
+        # usage stays bounded by the current batch
+        used_digests = {job[5] for job in jobs if job[5]}
+        for key in list(tmp_paths):
+            if key not in used_digests:
+                stale = tmp_paths.pop(key)
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+        st.info(f"Extracting **{len(jobs)}** file(s) (mode **{mode}**) ...")
+
+        def run_job(job):
+            _, file_name, file_size, payload, tmp_path, digest = job
+            compress = _GZIP_UPLOADS and os.path.splitext(file_name)[1].lower() in _COMPRESSIBLE_EXTS
+            # skip the cache for big native_text jobs: the result can be
+            # nearly as large as the file and would bloat cache memory
+            if mode == "native_text" and file_size > 8 * 1024 * 1024:
+                return whisper_extract(payload, api_key, mode, pages, vert, horiz, compress=compress)
+            if digest is None:
+                digest = hashlib.sha256(payload).hexdigest()
+            return _extract_cached(digest, mode, pages, vert, horiz, api_key, payload, _compress=compress)
+
+        with st.spinner("Processing..."):
+            # overlap the documents on the API's queue; the shared session
+            # means at most one TLS handshake per worker for the batch
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = {executor.submit(run_job, job): (job[0], job[1]) for job in jobs}
+                for future in as_completed(futures):
+                    index, file_name = futures[future]
+                    try:
+                        data = future.result()
+                    except Exception as e:
+                        st.error(f"❌ {file_name}: {e}")
+                        continue
+                    text = (data or {}).get("result_text", "") or data.get("extracted_text", "")
+                    st.success(f"✅ {file_name}: extraction complete.")
+                    # key on the job index, not the name: the uploader can hold
+                    # two same-named files and duplicate keys abort the render
+                    st.text_area(f"Extracted Text — {file_name}", text, height=350, key=f"text_{index}")
+                    st.download_button(
+                        "Download as .txt",
+                        data=_utf8(text),
+                        file_name=f"{os.path.splitext(file_name)[0]}_extracted.txt",
+                        mime="text/plain",
+                        key=f"download_{index}",
+                    )
 
 if __name__ == "__main__":
     main()